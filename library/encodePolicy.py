@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import os
+from fractions import Fraction
+
+# containers the encoder writes HEVC into in place, see X265Encoder
+HEVC_CONTAINERS = (".mkv", ".mp4")
+# containers that hold AV1 and VP9 without needing a remux
+AV1_VP9_CONTAINERS = (".mkv", ".mp4", ".webm")
+
+# VP9 at or below this many bits per pixel per frame is already lean,
+# re-encoding it to HEVC gains little and costs quality
+VP9_BITS_PER_PIXEL = 0.1
+
+
+def bitsPerPixel(info):
+    """Return the bits per pixel per frame of the first video stream, None if unknown."""
+    try:
+        stream = info.videoStreams[0]
+        frameRate = float(Fraction(stream["avg_frame_rate"]))
+        bitRate = int(info.ffprobe["format"]["bit_rate"])
+        return bitRate / (stream["width"] * stream["height"] * frameRate)
+    except (IndexError, KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+def classify(info, filepath, vp9BitsPerPixel=VP9_BITS_PER_PIXEL):
+    """Decide whether a file in an efficient codec needs no re-encode.
+
+       Returns (action, reason) where action is "remux" for a stream copy into
+       .mkv, "skip" to leave the file alone, or None to use the normal rules.
+       HEVC that already meets the profile and height settings is only remuxed
+       when its container is not one the encoder can keep."""
+    try:
+        codec = info.videoStreams[0]["codec_name"]
+    except (IndexError, KeyError):
+        return None, None
+    container = os.path.splitext(filepath)[1].lower()
+
+    if codec == "hevc":
+        if info.isEncoded() and container not in HEVC_CONTAINERS:
+            return "remux", f"hevc in {container} container, stream copied to .mkv"
+        return None, None
+
+    if codec == "vp9":
+        rate = bitsPerPixel(info)
+        if rate is None or rate > vp9BitsPerPixel:
+            return None, None
+    elif codec != "av1":
+        return None, None
+
+    if container not in AV1_VP9_CONTAINERS:
+        return "remux", f"{codec} in {container} container, stream copied to .mkv"
+    return "skip", f"already efficient {codec}"
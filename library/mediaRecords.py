@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+import json
+import operator
+import os
+import sys
+import threading
+from collections.abc import MutableMapping
+
+# codec and profile names repeat across the whole library, they are stored
+# once here and referenced from records by their index
+_symbolNames = []
+_symbolIndex = {}
+# records are written from scan and encode threads at once
+_symbolLock = threading.Lock()
+
+_UNSET = object()
+
+
+def symbolId(name):
+    """Return the small integer used to store a codec or profile name."""
+    try:
+        return _symbolIndex[name]
+    except KeyError:
+        pass
+    with _symbolLock:
+        if name not in _symbolIndex:
+            _symbolNames.append(sys.intern(name))
+            _symbolIndex[name] = len(_symbolNames) - 1
+        return _symbolIndex[name]
+
+
+def symbolName(index):
+    """Return the codec or profile name stored under index."""
+    return _symbolNames[index]
+
+
+def residentMemory():
+    """Return the resident set size of this process in bytes, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # peak rather than current, reported in kB on linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+_encoder = json.JSONEncoder()
+
+
+class MediaRecord:
+    """Fixed slot replacement for the per file entry dictionaries.
+       Supports entry["key"] access so existing callers keep working,
+       unknown keys are kept in a small overflow dictionary."""
+
+    __slots__ = (
+        "file_size",
+        "duration",
+        "height",
+        "width",
+        "bit_rate",
+        "video_codec",
+        "video_profile",
+        "original_video_codec",
+        "original_codec",
+        "space_saved",
+        "error_message",
+        "subtitles",
+        "encode_time",
+        "encode_fps",
+        "encoder",
+        "preset",
+        "action",
+        "reason",
+        "crop",
+        "extra",
+    )
+    _fields = __slots__[:-1]
+    _symbolFields = frozenset(
+        ("video_codec", "video_profile", "original_video_codec", "original_codec",
+         "encoder", "preset", "action")
+    )
+    # the path is the key of the entry, it is not stored twice
+    _ignoredFields = frozenset(("filepath",))
+    _values = operator.attrgetter(*_fields)
+
+    def __init__(self, entry=None):
+        for field in self._fields:
+            setattr(self, field, _UNSET)
+        self.extra = None
+        if entry:
+            for key, value in entry.items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            value = getattr(self, key)
+            if value is _UNSET:
+                raise KeyError(key)
+            if key in self._symbolFields and value is not None:
+                return symbolName(value)
+            return value
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self._ignoredFields:
+            return
+        if key in self._fields:
+            if key in self._symbolFields and value is not None:
+                value = symbolId(value)
+            elif key == "file_size" and value is not None:
+                value = int(value)
+            elif key == "subtitles" and value is not None and not value:
+                # most files have no sidecars, share one empty value
+                value = ()
+            setattr(self, key, value)
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._fields:
+            if getattr(self, key) is _UNSET:
+                raise KeyError(key)
+            setattr(self, key, _UNSET)
+            return
+        if self.extra is None:
+            raise KeyError(key)
+        del self.extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [field for field in self._fields if getattr(self, field) is not _UNSET]
+        if self.extra:
+            keys += list(self.extra)
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def toDict(self):
+        entry = {}
+        symbolFields = self._symbolFields
+        for field, value in zip(self._fields, self._values(self)):
+            if value is _UNSET:
+                continue
+            if value is not None and field in symbolFields:
+                value = _symbolNames[value]
+            entry[field] = value
+        if self.extra:
+            entry.update(self.extra)
+        return entry
+
+
+class MediaTable(MutableMapping):
+    """Mapping of filepath to MediaRecord.
+       Entries are grouped by directory so each directory string is held once,
+       only the file name is stored per entry."""
+
+    def __init__(self, entries=None):
+        self._directories = {}
+        self._length = 0
+        if entries:
+            for filepath, entry in entries.items():
+                self[filepath] = entry
+
+    def __getitem__(self, filepath):
+        directory, name = os.path.split(filepath)
+        try:
+            return self._directories[directory][name]
+        except KeyError:
+            raise KeyError(filepath) from None
+
+    def __setitem__(self, filepath, entry):
+        if not isinstance(entry, MediaRecord):
+            entry = MediaRecord(entry)
+        directory, name = os.path.split(filepath)
+        try:
+            files = self._directories[directory]
+        except KeyError:
+            files = self._directories[sys.intern(directory)] = {}
+        if name not in files:
+            self._length += 1
+        files[name] = entry
+
+    def __delitem__(self, filepath):
+        directory, name = os.path.split(filepath)
+        try:
+            files = self._directories[directory]
+            del files[name]
+        except KeyError:
+            raise KeyError(filepath) from None
+        self._length -= 1
+        if not files:
+            del self._directories[directory]
+
+    def __contains__(self, filepath):
+        directory, name = os.path.split(filepath)
+        files = self._directories.get(directory)
+        return files is not None and name in files
+
+    def __iter__(self):
+        for directory, files in list(self._directories.items()):
+            for name in list(files):
+                yield os.path.join(directory, name)
+
+    def __len__(self):
+        return self._length
+
+    def rows(self, *fields):
+        """Yield (filepath, value, ...) for every record, None where a field is unset.
+           Values are stored values, codec fields are symbol ids."""
+        values = operator.attrgetter(*fields)
+        for directory, files in self._directories.items():
+            prefix = os.path.join(directory, "")
+            for name, record in files.items():
+                yield (prefix + name, *[None if value is _UNSET else value for value in values(record)])
+
+    def directoryEntries(self, directory):
+        """Return the file names and records tracked directly in directory."""
+        return self._directories.get(directory, {})
+
+    def dump(self, fileObject):
+        """Write the table as a JSON object, one entry at a time."""
+        encode = _encoder.encode
+        separator = "\n"
+        fileObject.write("{")
+        for directory, files in self._directories.items():
+            prefix = os.path.join(directory, "")
+            lines = [
+                f"    {encode(prefix + name)}: {encode(record.toDict())}"
+                for name, record in files.items()
+            ]
+            if lines:
+                fileObject.write(separator + ",\n".join(lines))
+                separator = ",\n"
+        fileObject.write("\n  }" if self._length else "}")
+
+
+def _decodeObject(pairs):
+    """object_pairs_hook building records and tables while the file is parsed,
+       so the entries never exist as dictionaries all at once."""
+    if pairs and isinstance(pairs[0][1], MediaRecord):
+        table = MediaTable()
+        for filepath, record in pairs:
+            table[filepath] = record
+        return table
+    keys = [key for key, _ in pairs]
+    if "incomplete_files" not in keys and any(key in MediaRecord._fields for key in keys):
+        record = MediaRecord()
+        for key, value in pairs:
+            record[key] = value
+        return record
+    return dict(pairs)
+
+
+_decoder = json.JSONDecoder(object_pairs_hook=_decodeObject)
+
+
+def _splitMember(line):
+    """Split '"key": value' into the decoded key and the value text,
+       the key is decoded first as paths may contain ': '."""
+    key, end = _decoder.raw_decode(line)
+    if not isinstance(key, str) or line[end:end + 2] != ": ":
+        raise ValueError(f"not an object member: {line[:80]}")
+    return key, line[end + 2:]
+
+
+def _loadLines(fileObject):
+    """Read the layout _libraryCommit writes, one entry per line.
+       Raises ValueError on anything else."""
+    if fileObject.readline().strip() != "{":
+        raise ValueError("not a streamed library file")
+    library = {}
+    for line in fileObject:
+        line = line.strip().rstrip(",")
+        if line == "}":
+            return library
+        key, value = _splitMember(line)
+        if value != "{":
+            library[key] = json.loads(value)
+            continue
+        table = library[key] = MediaTable()
+        for line in fileObject:
+            line = line.strip().rstrip(",")
+            if line == "}":
+                break
+            filepath, entry = _splitMember(line)
+            table[filepath] = _decoder.decode(entry)
+        else:
+            raise ValueError(f"{key} is not closed")
+    raise ValueError("library is not closed")
+
+
+def load(fileObject):
+    """Load a library file, converting each entry to a MediaRecord as it is read.
+       Files in the streamed layout are read a line at a time, other layouts
+       such as the indented one older versions wrote are parsed in one go."""
+    try:
+        return _loadLines(fileObject)
+    except ValueError:
+        fileObject.seek(0)
+        return json.load(fileObject, object_pairs_hook=_decodeObject)
+
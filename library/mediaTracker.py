@@ -1,10 +1,105 @@
 #!/usr/bin/env python3
+import bisect
 import os
 import json
+import queue
+import re
 import sys
 import subprocess
+import threading
+import time
 
+from library import encodePolicy
 from library import logger
+from library import mediaRecords
+from library import profiler
+
+SUBTITLE_FILE_TYPES = (".ass", ".ssa", ".sub", ".srt")
+
+
+def subtitleIndex(files):
+    """Return the sorted subtitle file names from a directory listing."""
+    return sorted(
+        name for name in files
+        if str.lower(os.path.splitext(name)[1]) in SUBTITLE_FILE_TYPES
+    )
+
+
+def sidecarSubtitles(videoName, index):
+    """Return subtitle names from index that belong to videoName.
+       A sidecar starts with the video basename followed by a dot,
+       'movie.srt' and 'movie.en.forced.srt' match movie.mkv,
+       'movie2.srt' and 'movie (2010).srt' do not."""
+    base = os.path.splitext(videoName)[0]
+    matches = []
+    position = bisect.bisect_left(index, base)
+    while position < len(index) and index[position].startswith(base):
+        name = index[position]
+        if len(name) > len(base) and name[len(base)] == ".":
+            matches.append(name)
+        position += 1
+    return matches
+
+
+def probeSubtitles(directory, names, args):
+    """Probe sidecar subtitle files so encodes can map them without rescanning."""
+    sidecars = []
+    for name in names:
+        subtitleFile = VideoInformation(os.path.join(directory, name), args)
+        if subtitleFile.analyze(tier="subtitle") is False:
+            continue
+        sidecars.append({"name": name, "streams": subtitleFile.subtitleEntry()})
+    return sidecars
+
+
+# count, seconds and bytes read for each probe tier, "deep" only counts full
+# probes scan falls back to, sidecar and pre-encode probes have their own tiers
+probeStats = {"fast": [0, 0.0, 0], "deep": [0, 0.0, 0], "subtitle": [0, 0.0, 0], "encode": [0, 0.0, 0]}
+
+# AVIOContext reports this at verbose level when the input is closed
+_bytesReadPattern = re.compile(rb"Statistics: (\d+) bytes read")
+
+
+def probeSummary():
+    """Return a line per probe tier with count, average latency and bytes read."""
+    lines = []
+    for tier, (count, seconds, bytesRead) in probeStats.items():
+        if count:
+            lines.append(f"{tier} probes: {count}, "
+                         f"{seconds / count * 1000:.0f}ms average, "
+                         f"{bytesRead / count / 1000:.0f}kB average read")
+    return lines
+
+
+class BlacklistIndex:
+    """Blacklisted directories as a tree of path components.
+       A path is blacklisted when one of its leading components matches a
+       whole entry, so /media/tv covers /media/tv/show but not /media/tv2."""
+
+    def __init__(self, paths):
+        self.root = {}
+        for path in paths:
+            node = self.root
+            for component in self._components(path):
+                node = node.setdefault(component, {})
+            node[None] = path
+
+    def _components(self, path):
+        return [component for component in os.path.normpath(path).split(os.sep) if component]
+
+    def match(self, path):
+        """Return the blacklist entry covering path, None if it is not blacklisted."""
+        node = self.root
+        if None in node:
+            return node[None]
+        for component in self._components(path):
+            node = node.get(component)
+            if node is None:
+                return None
+            if None in node:
+                return node[None]
+        return None
+
 
 class VideoInformation:
     def __init__(self, fp, args):
@@ -18,22 +113,39 @@ class VideoInformation:
         else:
             self.log = logger.setup_logging(None)        
 
-    def analyze(self):
-        self.command = [
-            "ffprobe",
-            "-v",
-            "quiet",
-            "-print_format",
-            "json",
-            "-show_format",
-            "-show_streams",
-            self.filepath,
-        ]
+    def analyze(self, fast=False, tier="deep"):
+        """ffprobe the file. The fast tier only reads the entries scan needs
+           from the start of the file, see conclusive() for when it is enough.
+           A full probe is counted in probeStats under tier."""
+        self.command = ["ffprobe", "-v", "verbose", "-print_format", "json"]
+        if fast:
+            tier = "fast"
+            self.command += [
+                "-probesize", "1000000",
+                "-analyzeduration", "1000000",
+                "-show_entries",
+                "format=size,duration,bit_rate"
+                ":stream=index,codec_type,codec_name,profile,width,height,avg_frame_rate"
+                ":stream_disposition=attached_pic",
+            ]
+        else:
+            self.command += ["-show_format", "-show_streams"]
+        self.command += [self.filepath]
+        beginTime = time.time()
         try:
-            self.ffprobe = json.loads(subprocess.check_output(self.command))
+            with profiler.phase("ffprobe"):
+                result = subprocess.run(self.command, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, check=True)
+            with profiler.phase("json"):
+                self.ffprobe = json.loads(result.stdout)
         except subprocess.CalledProcessError as error:
             self.log.error(f'{error}\ncommand {" ".join(self.command)}')
             return False
+        finally:
+            stats = probeStats[tier]
+            stats[0] += 1
+            stats[1] += time.time() - beginTime
+        stats[2] += sum(int(found) for found in _bytesReadPattern.findall(result.stderr))
 
         self.streams = self.ffprobe["streams"]
         self.videoStreams = [
@@ -57,6 +169,22 @@ class VideoInformation:
             if stream["codec_type"] == "video" and stream["disposition"]["attached_pic"]
         ]
 
+    def conclusive(self):
+        """Return True if the probe has everything simpleEntry and advEntry need."""
+        try:
+            stream = self.videoStreams[0]
+            # parameters not found within the probe size come back as 0 or none
+            if stream["codec_name"] in ("", "none", "unknown") or stream["width"] <= 0 or stream["height"] <= 0:
+                return False
+            self.ffprobe["format"]["size"]
+            float(self.ffprobe["format"]["duration"])
+            int(self.ffprobe["format"]["bit_rate"])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return False
+        if stream["codec_name"] == "hevc" and "profile" not in stream:
+            return False
+        return True
+
     def isEncoded(self):
         for stream in self.videoStreams:
             if stream["codec_name"] != "hevc":
@@ -85,6 +213,13 @@ class VideoInformation:
         self.entry["duration"] = int(float(self.ffprobe["format"]["duration"]))
         return self.entry
 
+    def subtitleEntry(self):
+        """Return the subtitle streams of a sidecar file for storing in an entry."""
+        return [
+            {"index": stream["index"], "codec_name": stream["codec_name"]}
+            for stream in self.subtitleStreams
+        ]
+
     def advEntry(self):
         try:
             self.entry["bit_rate"] = int(self.ffprobe["format"]["bit_rate"]) / 1000
@@ -102,6 +237,7 @@ class MediaLibrary:
         self.height_threshold = False
         self.height_ceiling = False
         self.force_encode = False
+        self.vp9_bits_per_pixel = encodePolicy.VP9_BITS_PER_PIXEL
         if args.verbose:
             self.log = logger.setup_logging(None, "DEBUG")
         elif args.quiet:
@@ -109,7 +245,10 @@ class MediaLibrary:
         else:
             self.log = logger.setup_logging(None)        
         self.libraryFilePath = (os.path.abspath(databasePath))
-        self.videoFileTypes = [
+        # held while file lists change, focus mode scans and encodes in parallel
+        self.lock = threading.RLock()
+        self.fileLists = ["incomplete_files", "skipped_files", "complete_files", "failed_files"]
+        self.videoFileTypes = {
             ".3gp",
             ".avi",
             ".flv",
@@ -123,7 +262,7 @@ class MediaLibrary:
             ".webm",
             ".wmv",
             ".m4v"
-        ]
+        }
         if not os.path.exists(os.path.dirname(self.libraryFilePath)):
             os.makedirs(os.path.dirname(self.libraryFilePath), exist_ok=True)
         if not os.path.isfile(self.libraryFilePath):
@@ -131,137 +270,262 @@ class MediaLibrary:
             self.library = {}
             self.library["paths"] = []
             self.library["blacklist"] = []
-            self.library["incomplete_files"] = {}
-            self.library["skipped_files"] = {}
-            self.library["complete_files"] = {}
-            self.library["failed_files"] = {}
+            self.library["incomplete_files"] = mediaRecords.MediaTable()
+            self.library["skipped_files"] = mediaRecords.MediaTable()
+            self.library["complete_files"] = mediaRecords.MediaTable()
+            self.library["failed_files"] = mediaRecords.MediaTable()
             self.library["space_saved"] = 0
             self._libraryCommit()
         print("loading library")
+        memoryBefore = mediaRecords.residentMemory()
         with open(self.libraryFilePath) as jsonFile:
-            self.library = json.load(jsonFile)
+            self.library = mediaRecords.load(jsonFile)
+        for fileList in self.fileLists:
+            if not isinstance(self.library[fileList], mediaRecords.MediaTable):
+                self.library[fileList] = mediaRecords.MediaTable(self.library[fileList])
+        memoryAfter = mediaRecords.residentMemory()
+        if memoryBefore is not None and memoryAfter is not None:
+            entryCount = sum(len(self.library[fileList]) for fileList in self.fileLists)
+            self.log.debug(f"library loaded, {entryCount} entries, "
+                           f"memory {memoryBefore/1_000_000:.1f}mb before "
+                           f"{memoryAfter/1_000_000:.1f}mb after")
 
     def scan(self, path, args):
         """Searching through files in path that are not in database.
            ffprobe them and add metadata to database."""
+        for _ in self.scanFiles(path, args):
+            pass
+        self._scanCompleted()
+
+    def _scanCompleted(self):
+        """Commit a finished scan and log the probe tiers, counted since start."""
+        self._libraryCommit()
+        for line in probeSummary():
+            self.log.info(line)
+        self.log.info("Scan completed")
+
+    def scanFiles(self, path, args, stopped=None, excluded=None):
+        """Scan path, yielding each file in incomplete_files as soon as it is
+           classified. The library is changed under self.lock but not committed.
+           stopped is checked before each directory, the scan ends once it returns True.
+           excluded returns paths to leave alone, the backup and output of a
+           running encode, it is checked for each file."""
         self.log.info(f" MediaLibrary scanning {path}")
-        for root, _, files in os.walk(path):
-            root_valid = True
-            for blacklist_entry in self.library["blacklist"]:
-                if blacklist_entry in root:
-                    self.log.debug( f'{root} is within blacklisted folder {blacklist_entry}')
-                    root_valid = False
-                    break
-            if not root_valid:
-                continue 
+        blacklist = BlacklistIndex(self.library["blacklist"])
+        blacklist_entry = blacklist.match(path)
+        if blacklist_entry:
+            self.log.debug(f'{path} is within blacklisted folder {blacklist_entry}')
+            return
+        for root, dirs, files in profiler.timedIterator("walk", os.walk(path)):
+            if stopped is not None and stopped():
+                return
+            # prune blacklisted subdirectories so the walk never descends into them
+            with profiler.phase("blacklist"):
+                kept = []
+                for directory in dirs:
+                    blacklist_entry = blacklist.match(os.path.join(root, directory))
+                    if blacklist_entry:
+                        self.log.debug(f'{os.path.join(root, directory)} is within blacklisted folder {blacklist_entry}')
+                    else:
+                        kept.append(directory)
+                dirs[:] = kept
+            subtitles = subtitleIndex(files)
             for name in files:
                 if str.lower(os.path.splitext(name)[1]) not in self.videoFileTypes:
                     self.log.debug(f'{name} is not a video')
                     continue
-                self.filepath = os.path.join(root, name)
+                filepath = os.path.join(root, name)
 
+                if excluded is not None and filepath in excluded():
+                    self.log.debug(f'{name} belongs to a running encode')
+                    continue
+                if filepath in self.library["incomplete_files"]:
+                    self.log.debug(f'{name} is already tracked')
+                    yield filepath
+                    continue
                 if (
-                    self.filepath in self.library["incomplete_files"]
-                    or self.filepath in self.library["complete_files"]
-                    or self.filepath in self.library["failed_files"]
+                    filepath in self.library["complete_files"]
+                    or filepath in self.library["failed_files"]
                 ):
                     self.log.debug(f'{name} is already tracked')
                     continue
-                if ( self.filepath in self.library["skipped_files"] ):
+                if ( filepath in self.library["skipped_files"] ):
                     self.log.debug(f'{name} is already skipped')
                     continue
 
                 # Windows path limit. Fatal
-                if len(self.filepath) > 255:
+                if len(filepath) > 255:
                     continue
-                print(self.filepath)
-
-                self.info = VideoInformation(self.filepath,args)
-                self.info.low_profile = self.low_profile
-                self.info.height = self.height
-                self.analyzeResult = self.info.analyze()
-                if self.analyzeResult is False:
-                    error = f"VideoInformation failed reading {self.filepath}"
+                print(filepath)
+
+                info = VideoInformation(filepath,args)
+                info.low_profile = self.low_profile
+                info.height = self.height
+                analyzeResult = info.analyze(fast=True)
+                if analyzeResult is False or not info.conclusive():
+                    self.log.debug(f"{name} fast probe inconclusive, running full probe")
+                    analyzeResult = info.analyze()
+                if analyzeResult is False:
+                    error = f"VideoInformation failed reading {filepath}"
                     self.log.critical(error)
                     failedEntry = {}
-                    failedEntry["filepath"] = self.filepath
-                    failedEntry["errorMessage"] = error
-                    self.library["failed_files"][self.filepath] = failedEntry
+                    failedEntry["error_message"] = error
+                    with self.lock:
+                        self.library["failed_files"][filepath] = failedEntry
                     continue
                 try:
-                    self.entry = self.info.simpleEntry()
+                    entry = info.simpleEntry()
                 except KeyError as error:
-                    self.markFailed(self.filepath, error)
+                    self.markFailed(filepath, error)
                     continue
                 try:
-                    self.info.advEntry()
+                    info.advEntry()
                 except KeyError as error:
-                    print(json.dumps(self.info.ffprobe, indent=2))
+                    print(json.dumps(info.ffprobe, indent=2))
                     return
-
-                if (self.rate_threshold and self.entry["bit_rate"] < self.rate_threshold ):
-                    self.library["skipped_files"][self.filepath] = self.entry
-                    self.log.info(f'{self.entry["width"]}x{self.entry["height"]} @ {self.entry["bit_rate"]}kbps -- Skipping File, below the bit rate threshold')
-                elif (self.rate_ceiling and self.entry["bit_rate"] > self.rate_ceiling ):
-                    self.library["skipped_files"][self.filepath] = self.entry
-                    self.log.info(f'{self.entry["width"]}x{self.entry["height"]} @ {self.entry["bit_rate"]}kbps -- Skipping File, above the bit rate ceiling')
-                elif (self.height_threshold and self.entry["height"] < self.height_threshold ):
-                    self.library["skipped_files"][self.filepath] = self.entry
-                    self.log.info(f'{self.entry["width"]}x{self.entry["height"]} @ {self.entry["bit_rate"]}kbps -- Skipping File, below the height threshold')
-                elif (self.height_ceiling and self.entry["height"] > self.height_ceiling ):
-                    self.library["skipped_files"][self.filepath] = self.entry
-                    self.log.info(f'{self.entry["width"]}x{self.entry["height"]} @ {self.entry["bit_rate"]}kbps -- Skipping File, above the height ceiling')
-                elif (self.info.isEncoded() and not self.force_encode):
-                    self.library["complete_files"][self.filepath] = self.entry
-                    self.library["complete_files"][self.filepath]["original_codec"] = "hevc"
-                    self.library["complete_files"][self.filepath]["space_saved"] = 0
-                    self.log.debug(f'{self.entry["width"]}x{self.entry["height"]} @ {self.entry["bit_rate"]}kbps -- File is already encoded in HEVC')
-                elif (self.force_encode):
-                    self.library["incomplete_files"][self.filepath] = self.entry
-                    self.log.info(f'{self.entry["width"]}x{self.entry["height"]} @ {self.entry["bit_rate"]}kbps -- Adding to tracked list as forced HEVC re-encode')
-                else:
-                    self.library["incomplete_files"][self.filepath] = self.entry
-                    self.log.info(f'{self.entry["width"]}x{self.entry["height"]} @ {self.entry["bit_rate"]}kbps -- Adding to tracked list')
-                
-        self._libraryCommit()
-        self.log.info("Scan completed")
-
-    def markComplete(self, inputfp, outputfp=None):
-        """Move entry from incomplete_files to complete_files."""
+                entry["subtitles"] = probeSubtitles(
+                    root, sidecarSubtitles(name, subtitles), args)
+                action, reason = encodePolicy.classify(
+                    info, filepath, self.vp9_bits_per_pixel)
+
+                with self.lock:
+                    if (self.rate_threshold and entry["bit_rate"] < self.rate_threshold ):
+                        self.library["skipped_files"][filepath] = entry
+                        self.log.info(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- Skipping File, below the bit rate threshold')
+                    elif (self.rate_ceiling and entry["bit_rate"] > self.rate_ceiling ):
+                        self.library["skipped_files"][filepath] = entry
+                        self.log.info(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- Skipping File, above the bit rate ceiling')
+                    elif (self.height_threshold and entry["height"] < self.height_threshold ):
+                        self.library["skipped_files"][filepath] = entry
+                        self.log.info(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- Skipping File, below the height threshold')
+                    elif (self.height_ceiling and entry["height"] > self.height_ceiling ):
+                        self.library["skipped_files"][filepath] = entry
+                        self.log.info(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- Skipping File, above the height ceiling')
+                    elif (action == "skip" and not self.force_encode):
+                        entry["reason"] = reason
+                        self.library["skipped_files"][filepath] = entry
+                        self.log.info(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- Skipping File, {reason}')
+                    elif (action == "remux" and not self.force_encode):
+                        entry["action"] = action
+                        entry["reason"] = reason
+                        self.library["incomplete_files"][filepath] = entry
+                        self.log.info(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- Adding to tracked list for remux, {reason}')
+                    elif (info.isEncoded() and not self.force_encode):
+                        self.library["complete_files"][filepath] = entry
+                        self.library["complete_files"][filepath]["original_codec"] = "hevc"
+                        self.library["complete_files"][filepath]["space_saved"] = 0
+                        self.log.debug(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- File is already encoded in HEVC')
+                    elif (self.force_encode):
+                        self.library["incomplete_files"][filepath] = entry
+                        self.log.info(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- Adding to tracked list as forced HEVC re-encode')
+                    else:
+                        self.library["incomplete_files"][filepath] = entry
+                        self.log.info(f'{entry["width"]}x{entry["height"]} @ {entry["bit_rate"]}kbps -- Adding to tracked list')
+
+                if filepath in self.library["incomplete_files"]:
+                    yield filepath
+
+    def requalify(self, busy=()):
+        """Re-apply the threshold, ceiling and force encode settings to
+           skipped_files and incomplete_files from their stored metadata,
+           moving entries between the two lists in one commit.
+           Entries skipped for a recorded reason stay skipped unless forced,
+           files in busy, queued or being encoded, are left where they are.
+           Returns a dictionary of moves."""
+        rateThreshold, rateCeiling = self.rate_threshold, self.rate_ceiling
+        heightThreshold, heightCeiling = self.height_threshold, self.height_ceiling
+        remux = mediaRecords.symbolId("remux")
+        with self.lock:
+            # decided in one pass over the stored values, moved afterwards
+            pending = []
+            for fileList in ("skipped_files", "incomplete_files"):
+                rows = self.library[fileList].rows("bit_rate", "height", "reason", "action")
+                for filepath, rate, height, reason, action in rows:
+                    qualified = (
+                        (not rateThreshold or rate is None or rate >= rateThreshold)
+                        and (not rateCeiling or rate is None or rate <= rateCeiling)
+                        and (not heightThreshold or height is None or height >= heightThreshold)
+                        and (not heightCeiling or height is None or height <= heightCeiling)
+                        and (self.force_encode or reason is None or action == remux)
+                    )
+                    if qualified != (fileList == "incomplete_files") and filepath not in busy:
+                        pending.append((filepath, fileList))
+
+            moves = {"skipped_files to incomplete_files": 0, "incomplete_files to skipped_files": 0}
+            for filepath, fileList in pending:
+                destination = "skipped_files" if fileList == "incomplete_files" else "incomplete_files"
+                self.library[destination][filepath] = self.library[fileList].pop(filepath)
+                moves[f"{fileList} to {destination}"] += 1
+                self.log.debug(f"{filepath} moved from {fileList} to {destination}")
+            if any(moves.values()):
+                self._libraryCommit()
+        return moves
+
+    def _takeEntry(self, filepath, entry=None):
+        """Remove and return the entry of a file that finished encoding.
+           It is normally in incomplete_files but may have been moved or
+           cleared while it encoded, then entry, the one the encode started
+           from, is used so the result is still recorded."""
+        for fileList in ("incomplete_files", "skipped_files"):
+            if filepath in self.library[fileList]:
+                return self.library[fileList].pop(filepath)
+        self.log.warning(f"{filepath} was no longer tracked while encoding, recording it anyway")
+        return entry if entry is not None else {}
+
+    def markComplete(self, inputfp, outputfp=None, encodeStats=None, entry=None):
+        """Move entry from incomplete_files to complete_files.
+           encodeStats from the encoder are recorded on the entry.
+           entry is used if the file is no longer tracked, see _takeEntry."""
         if outputfp is None:
             outputfp = inputfp
         self.log.info(f"Completed transcoding {outputfp}")
-        self.newEntry = self.library["incomplete_files"].pop(inputfp)
+        with self.lock:
+            self.newEntry = self._takeEntry(inputfp, entry)
 
         try:
             self.newSize = os.path.getsize(outputfp)
         except FileNotFoundError:
             self.log.error("File not found, assuming filename character encoding error")
-            self.newSize = self.newEntry["file_size"]
+            self.newSize = self.newEntry.get("file_size", 0)
 
-        self.spaceSaved = int(self.newEntry["file_size"]) - int(self.newSize)
-        self.newEntry["original_video_codec"] = self.newEntry["video_codec"]
-        self.newEntry["video_codec"] = "hevc"
-        self.newEntry["video_profile"] = "Main"
+        self.spaceSaved = int(self.newEntry.get("file_size", self.newSize)) - int(self.newSize)
+        self.newEntry["original_video_codec"] = self.newEntry.get("video_codec")
+        if self.newEntry.get("action") != "remux":
+            self.newEntry["video_codec"] = "hevc"
+            self.newEntry["video_profile"] = "Main"
         self.newEntry["space_saved"] = self.spaceSaved
         self.newEntry["file_size"] = self.newSize
-        self.library["complete_files"][outputfp] = self.newEntry
-        self.library["space_saved"] += self.spaceSaved
-        self._libraryCommit()
+        if encodeStats:
+            for key, value in encodeStats.items():
+                self.newEntry[key] = value
+        with self.lock:
+            self.library["complete_files"][outputfp] = self.newEntry
+            self.library["space_saved"] += self.spaceSaved
+            self._libraryCommit()
+
+    def markSkipped(self, filepath, reason, entry=None):
+        """Move entry from incomplete_files to skipped_files, recording why.
+           entry is used if the file is no longer tracked, see _takeEntry."""
+        with self.lock:
+            entry = self._takeEntry(filepath, entry)
+            entry["reason"] = str(reason)
+            self.library["skipped_files"][filepath] = entry
+            self._libraryCommit()
+        self.log.info(f"{filepath} skipped, {reason}")
 
     def markFailed(self, filepath, errorMessage):
         """
             create entry in failed_files and
             remove file from incomplete_files if it exists.
         """
-        if filepath in self.library["incomplete_files"]:
-            entry = self.library["incomplete_files"].pop(filepath)
-        else:
-            entry = {}
-            entry["filepath"] = filepath
-        entry["error_message"] = str(errorMessage)
-        self.library["failed_files"][filepath] = entry
-        self._libraryCommit()
+        with self.lock:
+            if filepath in self.library["incomplete_files"]:
+                entry = self.library["incomplete_files"].pop(filepath)
+            else:
+                entry = {}
+            entry["error_message"] = str(errorMessage)
+            self.library["failed_files"][filepath] = entry
+            self._libraryCommit()
         self.log.error(f"{filepath} failed to convert, moving to failed_files")
 
     def showFailed(self):
@@ -288,30 +552,30 @@ class MediaLibrary:
 
     def clearAll(self):
         """Clear all file lists."""
-        self.library["skipped_files"] = {}
-        self.library["incomplete_files"] = {}
-        self.library["complete_files"] = {}
-        self.library["failed_files"] = {}
+        self.library["skipped_files"] = mediaRecords.MediaTable()
+        self.library["incomplete_files"] = mediaRecords.MediaTable()
+        self.library["complete_files"] = mediaRecords.MediaTable()
+        self.library["failed_files"] = mediaRecords.MediaTable()
         self._libraryCommit()
 
     def clearSkipped(self):
         """Clear the skipped file list."""
-        self.library["skipped_files"] = {}
+        self.library["skipped_files"] = mediaRecords.MediaTable()
         self._libraryCommit()
 
     def clearIncomplete(self):
         """Clear the incomplete file list."""
-        self.library["incomplete_files"] = {}
+        self.library["incomplete_files"] = mediaRecords.MediaTable()
         self._libraryCommit()
 
     def clearComplete(self):
         """Clear the complete file list."""
-        self.library["complete_files"] = {}
+        self.library["complete_files"] = mediaRecords.MediaTable()
         self._libraryCommit()
 
     def clearFailed(self):
         """Clear the failed file list."""
-        self.library["failed_files"] = {}
+        self.library["failed_files"] = mediaRecords.MediaTable()
         self._libraryCommit()
 
     def addBlacklistPath(self, filepath):
@@ -348,35 +612,47 @@ class MediaLibrary:
             sys.exit(100)
         return self.entryList
 
-    def returnDirectory(self, directory):
-        """Return all filepaths from directory in argument."""
-        directory = os.path.abspath(directory)
-        if not os.path.isdir(directory):
-            print(f"{directory} is not a valid path, exiting")
-            sys.exit()
-        self.scan(directory)
-        self.entryList = []
-        for file in os.listdir(directory):
-            fp = os.path.join(directory, file)
-            if os.path.splitext(fp)[1] not in self.videoFileTypes:
-                continue
-            if fp in self.library["complete_files"]:
-                self.log.debug(f"{fp} already completed")
-                continue
-            if fp in self.library["failed_files"]:
-                self.log.debug(f"{fp} has already failed conversion")
-                continue
+    def focusFiles(self, directories, args, queueSize=2, excluded=None):
+        """Yield files from directories for encoding as they are scanned.
+           A background thread scans recursively into a bounded queue so the
+           first encode starts as soon as its file is classified.
+           excluded is passed on to scanFiles."""
+        directories = [os.path.abspath(directory) for directory in directories]
+        for directory in directories:
+            if not os.path.isdir(directory):
+                print(f"{directory} is not a valid path, exiting")
+                sys.exit()
+        fileQueue = queue.Queue(maxsize=queueSize)
+
+        def producer():
             try:
-                self.entryList.append(fp)
-            except KeyError as errorMessage:
-                self.log.error(errorMessage)
-                print(errorMessage)
-                continue
-        return self.entryList
+                for directory in directories:
+                    for filepath in self.scanFiles(directory, args, excluded=excluded):
+                        fileQueue.put(filepath)
+                self._scanCompleted()
+            finally:
+                fileQueue.put(None)
+
+        threading.Thread(target=producer, daemon=True).start()
+        while True:
+            filepath = fileQueue.get()
+            if filepath is None:
+                return
+            yield filepath
 
     def returnTotalSaved(self):
         return self.library["space_saved"]
 
     def _libraryCommit(self):
-        with open(self.libraryFilePath, "w") as jsonFile:
-            jsonFile.write(json.dumps(self.library,indent=2))
+        """Write the library to disk, file lists are streamed entry by entry."""
+        with self.lock, profiler.phase("commit"), open(self.libraryFilePath, "w") as jsonFile:
+            separator = "\n"
+            jsonFile.write("{")
+            for key, value in self.library.items():
+                jsonFile.write(f"{separator}  {json.dumps(key)}: ")
+                if isinstance(value, mediaRecords.MediaTable):
+                    value.dump(jsonFile)
+                else:
+                    jsonFile.write(json.dumps(value))
+                separator = ",\n"
+            jsonFile.write("\n}\n")
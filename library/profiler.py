@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import atexit
+import cProfile
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+
+# phase name -> list of durations in seconds, filled only while enabled
+timings = {}
+_enabled = False
+_cProfile = None
+
+
+class _Timer:
+    __slots__ = ("name", "beginTime")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.beginTime = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        timings.setdefault(self.name, []).append(time.perf_counter() - self.beginTime)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_noTimer = _NoTimer()
+
+
+def phase(name):
+    """Context manager timing one occurrence of a phase, a no-op unless enabled."""
+    return _Timer(name) if _enabled else _noTimer
+
+
+def timedIterator(name, iterable):
+    """Yield from iterable, timing each step as a phase."""
+    if not _enabled:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with _Timer(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def enable(deep=False):
+    """Start collecting phase timings, with cProfile and tracemalloc if deep.
+       The report is printed when the process exits."""
+    global _enabled, _cProfile
+    _enabled = True
+    # every module logs through the same logger, time its handlers
+    log = logging.getLogger("library.logger")
+    handle = log.handle
+
+    def timedHandle(record):
+        with _Timer("logging"):
+            return handle(record)
+
+    log.handle = timedHandle
+    if deep:
+        tracemalloc.start()
+        _cProfile = cProfile.Profile()
+        _cProfile.enable()
+    atexit.register(report)
+
+
+def _percentile(durations, fraction):
+    return durations[int(fraction * (len(durations) - 1))]
+
+
+def report():
+    """Print count, total, p50 and p95 per phase, then the deep profile if taken."""
+    print(f"{'phase':<12}{'count':>10}{'total s':>12}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, durations in sorted(timings.items(), key=lambda item: -sum(item[1])):
+        durations = sorted(durations)
+        print(f"{name:<12}{len(durations):>10}{sum(durations):>12.3f}"
+              f"{_percentile(durations, 0.5) * 1000:>10.2f}"
+              f"{_percentile(durations, 0.95) * 1000:>10.2f}")
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+        print("top allocators")
+        for statistic in snapshot.statistics("lineno")[:10]:
+            print(statistic)
+    if _cProfile is not None:
+        _cProfile.disable()
+        output = io.StringIO()
+        pstats.Stats(_cProfile, stream=output).sort_stats("cumulative").print_stats(20)
+        print(output.getvalue())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+import collections
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+
+from library import throughputModel
+
+
+def request(socketPath, message):
+    """Send one request to a running service and return its response,
+       None if no service is listening on socketPath."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socketPath)
+            connection.sendall(json.dumps(message).encode() + b"\n")
+            connection.shutdown(socket.SHUT_WR)
+            response = b""
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                response += data
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    return json.loads(response)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline())
+            response = self.server.service.handle(message)
+        except Exception as error:
+            response = {"error": str(error)}
+        self.wfile.write(json.dumps(response).encode())
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class LibraryService:
+    """Keeps a MediaLibrary in memory and owns its encode queue.
+
+       Requests arrive as one JSON object per connection on a UNIX socket,
+       {"command": name, ...}, and are answered with one JSON object.
+       Files are encoded one at a time by a worker thread using encodeFile,
+       a callable taking a filepath and a callable it passes the encoder to,
+       with the settings the service was started with. Scans run one at a
+       time in a scanner thread."""
+
+    def __init__(self, library, socketPath, encodeFile, args):
+        self.library = library
+        self.socketPath = socketPath
+        self.encodeFile = encodeFile
+        self.args = args
+        self.log = library.log
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.paused = False
+        self.current = None
+        self.encoder = None
+        self.encoded = 0
+        self.stopping = False
+        self.scanner = None
+        self.commands = {
+            "enqueue": self.enqueue,
+            "status": self.status,
+            "stats": self.stats,
+            "errors": self.errors,
+            "pause": self.pause,
+            "resume": self.resume,
+            "clear": self.clear,
+            "scan": self.scan,
+            "track": self.track,
+            "blacklist": self.blacklist,
+            "paths": self.paths,
+            "plan": self.plan,
+            "requalify": self.requalify,
+        }
+
+    def serve(self):
+        """Listen on the socket until interrupted."""
+        if os.path.exists(self.socketPath):
+            if request(self.socketPath, {"command": "status"}) is not None:
+                raise RuntimeError(f"service already running on {self.socketPath}")
+            os.remove(self.socketPath)
+        previousUmask = os.umask(0o177)
+        try:
+            server = _Server(self.socketPath, _Handler)
+        finally:
+            os.umask(previousUmask)
+        server.service = self
+        # stop cleanly on kill as well as ctrl-c, removing the socket
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        worker = threading.Thread(target=self._work)
+        worker.start()
+        self.log.info(f"service listening on {self.socketPath}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.log.info("service stopping")
+        finally:
+            server.server_close()
+            os.remove(self.socketPath)
+            self._stop(worker)
+            self.log.info("service stopped")
+
+    def _stop(self, worker):
+        """Stop the running encode, restoring its original, and wait for the
+           worker and any scan to finish."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+            if self.encoder is not None:
+                self.encoder.stop()
+            scanner = self.scanner
+        worker.join()
+        if scanner is not None:
+            scanner.join()
+
+    def handle(self, message):
+        try:
+            command = self.commands[message.get("command")]
+        except KeyError:
+            return {"error": f"unknown command {message.get('command')}"}
+        return command(message)
+
+    def _encoderPaths(self):
+        """Return the backup and output paths of the running encode, which
+           scans must not pick up as new videos."""
+        with self.condition:
+            if self.encoder is None:
+                return ()
+            return (self.encoder.backupFilepath, self.encoder.outputFilepath)
+
+    def _started(self, encoder):
+        with self.condition:
+            self.encoder = encoder
+            if self.stopping:
+                encoder.stop()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while (self.paused or not self.queue) and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                self.current = self.queue.popleft()
+            try:
+                self.encodeFile(self.current, self._started)
+                self.encoded += 1
+            except (Exception, SystemExit) as error:
+                if not self.stopping:
+                    self.log.error(f"{self.current} stopped with {error!r}")
+            finally:
+                with self.condition:
+                    self.current = None
+                    self.encoder = None
+
+    def _enqueuePaths(self, filepaths):
+        with self.condition:
+            queued = set(self.queue)
+            added = [fp for fp in filepaths if fp not in queued and fp != self.current]
+            self.queue.extend(added)
+            self.condition.notify()
+        return len(added)
+
+    def _scanInBackground(self, directories, enqueue):
+        """Start a scanner thread, returns False if a scan is already running.
+           scanFiles is not safe to run twice at once on one library."""
+        def scanner():
+            try:
+                for directory in directories:
+                    for filepath in self.library.scanFiles(
+                            directory, self.args, lambda: self.stopping, self._encoderPaths):
+                        if enqueue:
+                            self._enqueuePaths([filepath])
+            finally:
+                self.library._scanCompleted()
+
+        with self.condition:
+            if self.stopping or (self.scanner is not None and self.scanner.is_alive()):
+                return False
+            self.scanner = threading.Thread(target=scanner)
+            self.scanner.start()
+        return True
+
+    def enqueue(self, message):
+        """Queue the first count files of incomplete_files, or scan and queue paths."""
+        if "count" in message:
+            with self.condition:
+                busy = set(self.queue)
+                busy.add(self.current)
+            with self.library.lock:
+                candidates = []
+                for filepath in self.library.library["incomplete_files"]:
+                    if len(candidates) >= message["count"]:
+                        break
+                    if filepath not in busy:
+                        candidates.append(filepath)
+            return {"queued": self._enqueuePaths(candidates)}
+        directories = [os.path.abspath(path) for path in message.get("paths", [])]
+        for directory in directories:
+            if not os.path.isdir(directory):
+                return {"error": f"{directory} is not a valid path"}
+        if not self._scanInBackground(directories, enqueue=True):
+            return {"error": "a scan is already running, try again when it finishes"}
+        return {"scanning": directories}
+
+    def status(self, message):
+        with self.condition:
+            return {
+                "paused": self.paused,
+                "current": self.current,
+                "queued": list(self.queue),
+                "encoded": self.encoded,
+                "scanning": self.scanner is not None and self.scanner.is_alive(),
+            }
+
+    def stats(self, message):
+        with self.library.lock:
+            stats = {fileList: len(self.library.library[fileList]) for fileList in self.library.fileLists}
+            stats["space_saved"] = self.library.returnTotalSaved()
+        return stats
+
+    def errors(self, message):
+        with self.library.lock:
+            failed = self.library.library["failed_files"]
+            return {"failed": [[filepath, failed[filepath].get("error_message", "unkown error")]
+                               for filepath in failed]}
+
+    def pause(self, message):
+        """Stop taking new files from the queue, the current encode finishes."""
+        with self.condition:
+            self.paused = True
+        return {"paused": True}
+
+    def resume(self, message):
+        with self.condition:
+            self.paused = False
+            self.condition.notify()
+        return {"paused": False}
+
+    def clear(self, message):
+        """Clear one file list, or all of them, dropping queued files that go with it.
+           The file being encoded stays in incomplete_files."""
+        clearFunctions = {
+            "all": self.library.clearAll,
+            "skipped": self.library.clearSkipped,
+            "incomplete": self.library.clearIncomplete,
+            "complete": self.library.clearComplete,
+            "failed": self.library.clearFailed,
+        }
+        fileList = message.get("list")
+        if fileList not in clearFunctions:
+            return {"error": f"unknown file list {fileList}"}
+        with self.condition:
+            current = self.current
+        with self.library.lock:
+            incomplete = self.library.library["incomplete_files"]
+            currentEntry = incomplete.get(current) if current else None
+            clearFunctions[fileList]()
+            if currentEntry is not None and current not in self.library.library["incomplete_files"]:
+                # the running encode is kept, its result is recorded from this entry
+                self.library.library["incomplete_files"][current] = currentEntry
+                self.library._libraryCommit()
+        if fileList in ("all", "incomplete"):
+            with self.condition:
+                self.queue.clear()
+        return {"cleared": fileList}
+
+    def scan(self, message):
+        if not self._scanInBackground(self.library.listPaths(), enqueue=False):
+            return {"error": "a scan is already running, try again when it finishes"}
+        return {"scanning": self.library.listPaths()}
+
+    def track(self, message):
+        for path in message.get("paths", []):
+            if not os.path.isdir(path):
+                return {"error": f"invalid directory {path}"}
+        with self.library.lock:
+            for path in message.get("paths", []):
+                self.library.addNewPath(path)
+        return {"paths": self.library.listPaths()}
+
+    def blacklist(self, message):
+        for path in message.get("paths", []):
+            if not os.path.isdir(path):
+                return {"error": f"invalid directory {path}"}
+        with self.library.lock:
+            for path in message.get("paths", []):
+                self.library.addBlacklistPath(path)
+        return {"blacklist": self.library.listBlacklistPaths()}
+
+    def paths(self, message):
+        return {"paths": self.library.listPaths(), "blacklist": self.library.listBlacklistPaths()}
+
+    def plan(self, message):
+        with self.library.lock:
+            model = throughputModel.ThroughputModel(self.library.library["complete_files"])
+            return model.estimateQueue(self.library.library["incomplete_files"],
+                                       message.get("encoder", "libx265"),
+                                       message.get("preset", "medium"),
+                                       message.get("count"))
+
+    def requalify(self, message):
+        """Apply new thresholds to stored entries, they also apply to later scans.
+           Queued files and the one being encoded are not moved."""
+        with self.condition:
+            busy = set(self.queue)
+            busy.add(self.current)
+        with self.library.lock:
+            for setting in ("rate_threshold", "rate_ceiling", "height_threshold",
+                            "height_ceiling", "force_encode"):
+                setattr(self.library, setting, message.get(setting) or False)
+            return self.library.requalify(busy)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+import itertools
+
+
+def heightClass(height):
+    """Group heights into the usual resolution classes."""
+    for limit in (480, 576, 720, 1080, 1440, 2160):
+        if height <= limit:
+            return limit
+    return 4320
+
+
+class ThroughputModel:
+    """Encode speed and size reduction learned from completed encodes.
+
+       Each completed entry with an encode_time contributes to a group keyed
+       by encoder, preset, resolution class and source codec. Speed is stored
+       as seconds of video encoded per second of wall time and size as the
+       fraction of the original kept, both summed so long files weigh more.
+       Estimates fall back to coarser groups when a key has no history."""
+
+    def __init__(self, completeFiles):
+        self.groups = {}
+        for entry in completeFiles.values():
+            try:
+                encodeTime = entry["encode_time"]
+                duration = entry["duration"]
+                newSize = int(entry["file_size"])
+                originalSize = newSize + int(entry["space_saved"])
+                key = self._key(
+                    entry["encoder"],
+                    entry["preset"],
+                    entry["height"],
+                    entry["original_video_codec"],
+                )
+            except (KeyError, TypeError, ValueError):
+                continue
+            if encodeTime <= 0 or duration <= 0 or originalSize <= 0:
+                continue
+            for level in range(1, len(key) + 1):
+                group = self.groups.setdefault(key[:level], [0, 0, 0, 0])
+                group[0] += duration
+                group[1] += encodeTime
+                group[2] += newSize
+                group[3] += originalSize
+
+    def _key(self, encoder, preset, height, codec):
+        return (encoder, preset, heightClass(height), codec)
+
+    def estimate(self, entry, encoder, preset):
+        """Return (encode seconds, bytes saved) for entry or None without history."""
+        try:
+            key = self._key(encoder, preset, entry["height"], entry["video_codec"])
+            duration = entry["duration"]
+            fileSize = int(entry["file_size"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        for level in range(len(key), 0, -1):
+            group = self.groups.get(key[:level])
+            if group:
+                videoSeconds, wallSeconds, newSize, originalSize = group
+                seconds = duration * wallSeconds / videoSeconds
+                saved = fileSize * (1 - newSize / originalSize)
+                return seconds, saved
+        return None
+
+    def estimateQueue(self, incompleteFiles, encoder, preset, count=None):
+        """Sum estimates over the queue, or its first count entries."""
+        plan = {"files": 0, "seconds": 0, "bytes_saved": 0, "unestimated": 0}
+        for filepath in itertools.islice(incompleteFiles, count):
+            plan["files"] += 1
+            estimate = self.estimate(incompleteFiles[filepath], encoder, preset)
+            if estimate is None:
+                plan["unestimated"] += 1
+                continue
+            plan["seconds"] += estimate[0]
+            plan["bytes_saved"] += estimate[1]
+        return plan
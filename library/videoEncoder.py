@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
-import glob
 import logging
 import sys
 import subprocess
 import os
+import re
 import time
+from fractions import Fraction
 
+from library import encodePolicy
 from library import mediaTracker
 from library import logger
+from library import profiler
 
 
 class X265Encoder:
@@ -29,11 +32,10 @@ class X265Encoder:
             ".mov", ".qt"]
         """
 
-        hevcContainers = [
-            ".mkv", ".mp4"
-        ]
+        hevcContainers = encodePolicy.HEVC_CONTAINERS
 
         self.filepath = filepath
+        self.args = args
         self.filepathBase, self.filepathExtension = os.path.splitext(self.filepath)
         self.backupFilepath = self.filepathBase + "_backup" + self.filepathExtension
         if self.filepathExtension.lower() in hevcContainers:
@@ -51,6 +53,22 @@ class X265Encoder:
         self.vbr = False
         self.minrate = False
         self.maxrate = False
+        # sidecar subtitles recorded during scan, None if the entry predates them
+        self.subtitles = None
+        # stream copy into .mkv only, set for entries encodePolicy marked for remux
+        self.remux = False
+        # abort when the projected output exceeds this fraction of the source size
+        self.abort_ratio = False
+        # encoded seconds before the projection is trusted, output starts with headers
+        self.abortMinimumSeconds = 120
+        # crop rectangle "w:h:x:y" from detectCrop, empty when there are no bars
+        self.crop = None
+        self.decode_threads = False
+        self.filter_threads = False
+        self.scaler = False
+        # running ffmpeg, and whether stop() was called from another thread
+        self.process = None
+        self.stopped = False
 
         if args.verbose:
             self.log = logger.setup_logging(None, "DEBUG")
@@ -77,13 +95,15 @@ class X265Encoder:
             return False
         return True
 
-    def _commandString(self):
-        self.command = ["ffmpeg", "-n", "-hide_banner"]
-        self.command += ["-i", self.backupFilepath]
+    def _commandString(self, inputFilepath=None):
+        self.command = ["ffmpeg", "-n", "-hide_banner", "-progress", "pipe:1"]
+        if self.decode_threads:
+            self.command += ["-threads", str(self.decode_threads)]
+        self.command += ["-i", inputFilepath or self.backupFilepath]
 
         self.externalSubtitles = self._subtitlePaths()
         for subtitle in self.externalSubtitles:
-            self.command += ["-i", f'"{subtitle}"']
+            self.command += ["-i", subtitle["filepath"]]
 
         self.command += ["-map_chapters", "0", "-map_metadata", "0"]
 
@@ -100,6 +120,20 @@ class X265Encoder:
         self.command += [self.outputFilepath]
         return self.command
 
+    def _remuxCommandString(self):
+        """Copy streams into the .mkv output without encoding.
+           Data streams such as .mov timecode tracks are dropped as Matroska
+           can not hold them, mov_text subtitles are converted to srt."""
+        self.command = ["ffmpeg", "-n", "-hide_banner", "-progress", "pipe:1"]
+        self.command += ["-i", self.backupFilepath]
+        self.command += ["-map", "0", "-map", "-0:d", "-c", "copy"]
+        for streamCounter, stream in enumerate(self.file.subtitleStreams):
+            if stream["codec_name"] == "mov_text":
+                self.command += [f"-c:s:{streamCounter}", "srt"]
+        self.command += ["-map_chapters", "0", "-map_metadata", "0"]
+        self.command += [self.outputFilepath]
+        return self.command
+
     def _mapAudioStreams(self):
         self.compatableAudioCodecs = [
             "aac",
@@ -169,18 +203,23 @@ class X265Encoder:
             else:
                 self.command += [f"-c:s:{self.streamCounter}", "ass"]
             self.streamCounter += 1
-        for subtitle in self.externalSubtitles:
-            self.subtitleFile = mediaTracker.VideoInformation(subtitle)
-            self.subtitleFile.analyze()
-            self.subtitleInformation = self.subtitleFile.subtitleStreams
-            self.streamCounter = 0
-            for stream in self.subtitleInformation:
-                self.command += [
-                    "-map",
-                    f'{self.externalSubtitles.index(subtitle)+1}:{stream["index"]}',
-                ]
+        # mp4 only takes mov_text, which can not hold bitmap subtitles
+        mp4Output = os.path.splitext(self.outputFilepath)[1].lower() == ".mp4"
+        bitmapSubtitleCodecs = ["dvd_subtitle", "hdmv_pgs_subtitle", "xsub"]
+        for inputIndex, subtitle in enumerate(self.externalSubtitles, start=1):
+            for stream in subtitle["streams"]:
+                if mp4Output and stream["codec_name"] in bitmapSubtitleCodecs:
+                    self.log.warning(f'skipping {subtitle["filepath"]}, '
+                                     f'{stream["codec_name"]} can not be muxed into mp4')
+                    continue
+                self.command += ["-map", f'{inputIndex}:{stream["index"]}']
                 compatableSub = stream["codec_name"] in self.compatableSubtitleCodecs
-                if self.compatableContainer or compatableSub:
+                if mp4Output:
+                    if stream["codec_name"] == "mov_text":
+                        self.command += [f"-c:s:{self.streamCounter}", "copy"]
+                    else:
+                        self.command += [f"-c:s:{self.streamCounter}", "mov_text"]
+                elif self.compatableContainer or compatableSub:
                     self.command += [f"-c:s:{self.streamCounter}", "copy"]
                 else:
                     self.command += [f"-c:s:{self.streamCounter}", "srt"]
@@ -192,17 +231,12 @@ class X265Encoder:
         if self.nvenc:
             self.log.debug("GPU encoding used")
             self.command += ["-c:v", "hevc_nvenc"]
-            if self.low_profile:
-                self.command += ["-pix_fmt", "yuv420p"]
-            else:
-                self.command += ["-pix_fmt", "p010le"]
+            pixelFormat = "yuv420p" if self.low_profile else "p010le"
         else:
             self.log.debug("CPU encoding used")
             self.command += ["-c:v", "libx265"]
-            if self.low_profile:
-                self.command += ["-pix_fmt", "yuv420p"]
-            else:
-                self.command += ["-pix_fmt", "yuv420p10le"]
+            pixelFormat = "yuv420p" if self.low_profile else "yuv420p10le"
+        self.command += ["-pix_fmt", pixelFormat]
 
         if self.vbr:
             self.command += ["-b:v", self.vbr]
@@ -218,9 +252,132 @@ class X265Encoder:
             self.log.debug("Main10 profile used")
             self.command += ["-profile:v", "main10"]
 
+        filters = []
+        if self.crop:
+            self.log.debug(f"Cropping black bars to {self.crop}")
+            filters.append(f"crop={self.crop}")
         if self.height:
             self.log.debug("Scaling to specified height")
-            self.command += ["-vf", f"scale=-1:{self.height}"]
+            # -2 keeps the width even, which 4:2:0 output requires
+            scale = f"scale=-2:{self.height}"
+            if self.scaler:
+                scale += f":flags={self.scaler}"
+            filters.append(scale)
+        if filters:
+            self.command += ["-vf", ",".join(filters)]
+            if self.filter_threads:
+                self.command += ["-filter_threads", str(self.filter_threads)]
+
+    def benchmark(self, args, seconds=60):
+        """Encode the first seconds of the file to nowhere with the current
+           settings and return the frames per second reached."""
+        self.file = mediaTracker.VideoInformation(self.filepath, args)
+        self.file.analyze(tier="encode")
+        self.command = self._commandString(self.filepath)
+        self.command = self.command[:-1] + ["-t", str(seconds), "-f", "null", "-"]
+        print(" ".join(self.command) + "\n")
+        fps = 0.0
+        process = subprocess.Popen(self.command, stdout=subprocess.PIPE, text=True)
+        for line in process.stdout:
+            key, _, value = line.strip().partition("=")
+            if key == "fps":
+                try:
+                    fps = float(value)
+                except ValueError:
+                    pass
+        if process.wait() != 0:
+            raise EncoderFailedError(f"benchmark of {self.filepath} failed")
+        return fps
+
+    def detectCrop(self, duration, width, height, samples=5, sampleSeconds=2):
+        """Run cropdetect on a few short samples spread over the file and
+           return the rectangle enclosing all of them as "w:h:x:y".
+           Returns an empty string when less than 2% of the frame would go."""
+        rectangles = []
+        for sample in range(1, samples + 1):
+            command = [
+                "ffmpeg", "-hide_banner", "-nostats",
+                "-ss", str(duration * sample / (samples + 1)),
+                "-i", self.filepath,
+                "-t", str(sampleSeconds),
+                "-map", "0:v:0",
+                # a limit below 1 is scaled to the bit depth, 24 would miss
+                # the black of 10-bit sources which sits around 64
+                "-vf", "cropdetect=0.094:2:0",
+                "-f", "null", "-",
+            ]
+            with profiler.phase("cropdetect"):
+                result = subprocess.run(command, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE, text=True)
+            found = re.findall(r"crop=(\d+):(\d+):(\d+):(\d+)", result.stderr)
+            if result.returncode == 0 and found:
+                # cropdetect accumulates without reset, the last line covers the sample
+                rectangles.append([int(value) for value in found[-1]])
+        if not rectangles:
+            return ""
+        left = min(x for _, _, x, _ in rectangles)
+        top = min(y for _, _, _, y in rectangles)
+        right = max(x + w for w, _, x, _ in rectangles)
+        bottom = max(y + h for _, h, _, y in rectangles)
+        left -= left % 2
+        top -= top % 2
+        cropWidth = min(right - left, width - left)
+        cropHeight = min(bottom - top, height - top)
+        cropWidth -= cropWidth % 2
+        cropHeight -= cropHeight % 2
+        if cropWidth * cropHeight > 0.98 * width * height:
+            return ""
+        self.log.info(f"black bars detected, cropping {width}x{height} to {cropWidth}x{cropHeight}")
+        return f"{cropWidth}:{cropHeight}:{left}:{top}"
+
+    def _runFfmpeg(self):
+        """Run the ffmpeg command, following its -progress output to abort
+           encodes projected to end up larger than abort_ratio of the source."""
+        process = self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, text=True)
+        try:
+            if self.stopped:
+                process.terminate()
+            outputSize = encodedSeconds = None
+            for line in process.stdout:
+                key, _, value = line.strip().partition("=")
+                if key == "total_size" and value.isdigit():
+                    outputSize = int(value)
+                elif key == "out_time_us" and value.isdigit():
+                    encodedSeconds = int(value) / 1_000_000
+                elif key == "progress" and outputSize and encodedSeconds:
+                    self._checkProjectedSize(outputSize, encodedSeconds)
+            if self.stopped:
+                # handled like ctrl-c, the original file is restored
+                raise KeyboardInterrupt
+        except BaseException:
+            process.terminate()
+            process.wait()
+            raise
+        return process.wait()
+
+    def stop(self):
+        """Terminate a running encode from another thread, encode() then
+           restores the original file as it does on ctrl-c."""
+        self.stopped = True
+        if self.process is not None:
+            self.process.terminate()
+
+    def _checkProjectedSize(self, outputSize, encodedSeconds):
+        if not self.abort_ratio or self.remux:
+            return
+        try:
+            duration = float(self.file.ffprobe["format"]["duration"])
+            sourceSize = int(self.file.ffprobe["format"]["size"])
+        except (KeyError, ValueError):
+            return
+        if encodedSeconds < min(self.abortMinimumSeconds, duration / 2):
+            return
+        projectedSize = outputSize * duration / encodedSeconds
+        if projectedSize > self.abort_ratio * sourceSize:
+            raise ProjectedSizeError(
+                f"projected output {int(projectedSize/1_000_000)}mb exceeds "
+                f"{self.abort_ratio} of source {int(sourceSize/1_000_000)}mb "
+                f"after {int(encodedSeconds)}s of {int(duration)}s")
 
     def _restore(self):
         if os.path.exists(self.backupFilepath):
@@ -235,14 +392,35 @@ class X265Encoder:
             return False
 
     def _subtitlePaths(self):
-        self.subtitleExtensions = [".ass", ".ssa", ".sub", ".srt"]
-        self.subtitleFiles = []
-        for extension in self.subtitleExtensions:
-            # glob chokes on '[]', escape [ and ]
-            self.pattern = f"{self.filepathBase}*{extension}"
-            self.pattern = self.pattern.translate({ord("["): "[[]", ord("]"): "[]]"})
-            self.subtitleFiles += glob.glob(self.pattern)
-        return self.subtitleFiles
+        """Return sidecar subtitles with their streams, as recorded at scan time.
+           Entries scanned before sidecars were recorded fall back to a single
+           directory listing."""
+        directory, name = os.path.split(self.filepath)
+        if self.subtitles is None:
+            index = mediaTracker.subtitleIndex(os.listdir(directory))
+            self.subtitles = mediaTracker.probeSubtitles(
+                directory, mediaTracker.sidecarSubtitles(name, index), self.args)
+        return [
+            {"filepath": os.path.join(directory, subtitle["name"]),
+             "streams": subtitle["streams"]}
+            for subtitle in self.subtitles
+        ]
+
+    def encodeStats(self):
+        """Return wall time, frame rate and settings of the finished encode
+           for recording in the library entry."""
+        stats = {
+            "encode_time": round(self.encodeTime, 1),
+            "encoder": "copy" if self.remux else "hevc_nvenc" if self.nvenc else "libx265",
+            "preset": self.preset,
+        }
+        try:
+            frameRate = Fraction(self.file.videoStreams[0]["avg_frame_rate"])
+            duration = float(self.file.ffprobe["format"]["duration"])
+            stats["encode_fps"] = round(float(frameRate) * duration / self.encodeTime, 2)
+        except (IndexError, KeyError, ValueError, ZeroDivisionError):
+            pass
+        return stats
 
     def _validateNewFile(self, filepath):
         """ Perform some checks on output file to check whether the transcode worked
@@ -263,9 +441,9 @@ class X265Encoder:
             self.file.low_profile = True
         if self.height:
             self.file.height = self.height
-        self.file.analyze()
+        self.file.analyze(tier="encode")
 
-        if self.file.isEncoded():
+        if self.file.isEncoded() and not self.remux:
             alreadyX265 = (f'{self.filepath} already encoded,'
                            'moved to completed without doing anything')
             self.log.error(alreadyX265)
@@ -273,15 +451,25 @@ class X265Encoder:
 
         self._backup()
 
-        self.command = self._commandString()
+        with profiler.phase("command"):
+            if self.remux:
+                self.command = self._remuxCommandString()
+            else:
+                self.command = self._commandString()
         print(" ".join(self.command) + "\n")
+        beginTime = time.time()
         try:
-            self.result = subprocess.call(self.command)
+            self.result = self._runFfmpeg()
         except KeyboardInterrupt:
             self.log.info("cleaning up")
             self.log.error("Keyboard interrupt")
             self._restore()
             sys.exit()
+        except ProjectedSizeError as error:
+            self.log.warning(error.strerror)
+            self._restore()
+            raise
+        self.encodeTime = time.time() - beginTime
 
         if self.result != 0:
             ffmpegError = (f"failed encoding {self.filepath}, FFMPEG error {self.result}")
@@ -324,3 +512,8 @@ class EncoderFailedError(Error):
     def __init__(self, arg):
         self.strerror = arg
         self.args =  {arg}
+
+class ProjectedSizeError(Error):
+    def __init__(self, arg):
+        self.strerror = arg
+        self.args =  {arg}
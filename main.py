@@ -9,6 +9,226 @@ import sys
 from library import mediaTracker
 from library import videoEncoder
 from library import logger
+from library import profiler
+from library import service
+from library import throughputModel
+
+def configureEncoder(encoder, args, log):
+    """Apply the encoding settings from the command line to encoder."""
+    if args.low_profile:
+        encoder.low_profile = True
+    if args.nvenc:
+        encoder.nvenc = True
+    if args.height:
+        encoder.height = args.height
+    if args.crf:
+        if 0 < args.crf < 51:
+            encoder.crf = args.crf
+        else:
+            raise ValueError("CRF value unacceptable, must be between 0 and 51")
+    if args.preset:
+        validPresets = ["ultrafast", "superfast", "veryfast",
+                        "faster", "fast", "medium", "slow",
+                        "slower", "veryslow", "placebo"]
+        nvencPresets = ["fast", "medium", "slow"]
+        preset = args.preset.lower()
+        if preset in validPresets:
+            if args.nvenc and args.preset.lower() not in nvencPresets:
+                log.error("invalid nvenc preset passed with nvenc selected, please use fast, medium, or slow")
+                sys.exit()
+            encoder.preset = preset
+        else:
+            raise ValueError("preset not a valid argument, please use ultrafast, superfast, veryfast, faster, fast, medium, slow, slower, veryslow or placebo")
+    if args.height:
+        encoder.height = args.height
+    if args.vbr:
+        encoder.vbr = args.vbr
+        if args.minrate:
+            encoder.minrate = args.minrate
+        if args.maxrate:
+            encoder.maxrate = args.maxrate
+    if args.decode_threads:
+        encoder.decode_threads = args.decode_threads
+    if args.filter_threads:
+        encoder.filter_threads = args.filter_threads
+    if args.scaler:
+        encoder.scaler = args.scaler
+
+
+def encodeFile(library, filepath, args, log, started=None):
+    """Encode one file from incomplete_files and record the result.
+       started is called with the encoder before it runs, so the service
+       can stop it. Returns space saved and time taken, or None if the file failed."""
+    print(filepath)
+    beginTime = time.time()
+    try:
+        libraryEntry = library.library["incomplete_files"][filepath]
+    except KeyError:
+        log.warning(f"{filepath} is no longer in incomplete_files")
+        return 0, 0
+
+    # check json db if encoded before running encoder
+    try:
+        matchLow = args.low_profile and libraryEntry["video_profile"] == "Main"
+        matchHigh = not args.low_profile
+        remux = libraryEntry.get("action") == "remux"
+        if not remux and libraryEntry["video_codec"] == "hevc" and (matchLow or matchHigh) and (not args.height or args.height == libraryEntry["height"]):
+            library.markComplete(filepath)
+            return 0, 0
+    except KeyError:
+        return 0, 0
+
+    encoder = videoEncoder.X265Encoder(filepath, args)
+    if started:
+        started(encoder)
+    encoder.subtitles = libraryEntry.get("subtitles")
+    encoder.remux = remux
+    if args.abort_ratio:
+        encoder.abort_ratio = args.abort_ratio
+    if args.auto_crop and not remux:
+        # detected once per file, kept on the entry for retries
+        if libraryEntry.get("crop") is None:
+            try:
+                libraryEntry["crop"] = encoder.detectCrop(
+                    libraryEntry["duration"], libraryEntry["width"], libraryEntry["height"])
+            except KeyError:
+                libraryEntry["crop"] = ""
+        encoder.crop = libraryEntry["crop"]
+    configureEncoder(encoder, args, log)
+
+    try:
+        encodeResult = encoder.encode(args)
+    except videoEncoder.AlreadyEncodedError:
+        library.markComplete(filepath, entry=libraryEntry)
+        return 0, 0
+    except videoEncoder.ProjectedSizeError as e:
+        library.markSkipped(filepath, e, libraryEntry)
+        return 0, 0
+    except (videoEncoder.InvalidFileError, videoEncoder.EncoderFailedError) as e:
+        errorMessage = f"x265 convert failed with error: {e}"
+        library.markFailed(filepath, errorMessage)
+        return None
+
+    library.markComplete(filepath, encodeResult, encoder.encodeStats(), libraryEntry)
+    fileSpaceSaved = library.library["complete_files"][encodeResult]["space_saved"]
+    elapsedTime = time.time() - beginTime
+    elapsedTimeString = time.strftime("%H:%M:%S", time.localtime(elapsedTime))
+    log.info(f"space saved {fileSpaceSaved/1_000_000} : time taken {elapsedTimeString}.")
+    return fileSpaceSaved, elapsedTime
+
+
+def printSavedSpace(totalSaved):
+    totalSavedMB = int(totalSaved / 1_000_000)
+    totalSavedGB = (totalSavedMB / 1_000)
+    totalSavedTB = (totalSavedGB / 1_000)
+    if totalSavedTB > 1:
+        print(f"{totalSavedTB}tb")
+    elif totalSavedGB > 1:
+        print(f"{totalSavedGB}gb")
+    else:
+        print(f"{totalSavedMB}mb")
+
+
+def planSettings(args):
+    encoderName = "hevc_nvenc" if args.nvenc else "libx265"
+    preset = args.preset.lower() if args.preset else "medium"
+    return encoderName, preset
+
+
+def printPlan(plan):
+    print(f"files: {plan['files']}")
+    print(f"estimated encode time: {plan['seconds']/3600:.1f} hours")
+    print(f"estimated space saved: {plan['bytes_saved']/1_000_000_000:.1f}gb")
+    if plan["unestimated"]:
+        print(f"{plan['unestimated']} files could not be estimated, no encode history")
+
+
+def printMoves(moves):
+    for move, count in moves.items():
+        print(f"{count} moved from {move}")
+
+
+def serviceClient(socketPath, args):
+    """Forward the command line to the running service instead of loading the library.
+       Encoding settings are the ones the service was started with."""
+    def send(message):
+        response = service.request(socketPath, message)
+        if response is None:
+            print("service stopped responding")
+            sys.exit(1)
+        if "error" in response:
+            print(response["error"])
+            sys.exit(2)
+        return response
+
+    if args.errors:
+        for fp, errorMessage in send({"command": "errors"})["failed"]:
+            print(f"path: {fp}\nerror message: {errorMessage}\n")
+        return
+    if args.requalify:
+        printMoves(send({
+            "command": "requalify",
+            "rate_threshold": args.rate_threshold,
+            "rate_ceiling": args.rate_ceiling,
+            "height_threshold": args.height_threshold,
+            "height_ceiling": args.height_ceiling,
+            "force_encode": args.force_encode,
+        }))
+        return
+    if args.list_paths:
+        print(send({"command": "paths"})["paths"])
+        return
+    if args.list_blacklist_paths:
+        print(send({"command": "paths"})["blacklist"])
+        return
+    clearMessages = {
+        "all": "All file lists have been cleared",
+        "skipped": "Skipped file list has been cleared",
+        "incomplete": "Incomplete file list has been cleared",
+        "complete": "Complete file list has been cleared",
+        "failed": "Failed file list has been cleared",
+    }
+    for fileList, clearMessage in clearMessages.items():
+        if getattr(args, f"clear_{fileList}"):
+            send({"command": "clear", "list": fileList})
+            print(clearMessage)
+            return
+    if args.track:
+        send({"command": "track", "paths": [os.path.abspath(path) for path in args.track]})
+    if args.blacklist:
+        send({"command": "blacklist", "paths": [os.path.abspath(path) for path in args.blacklist]})
+    if args.saved_space:
+        printSavedSpace(send({"command": "stats"})["space_saved"])
+        return
+    if args.scan:
+        send({"command": "scan"})
+        print("scan started")
+    if args.plan:
+        encoderName, preset = planSettings(args)
+        printPlan(send({"command": "plan", "encoder": encoderName, "preset": preset, "count": args.number}))
+        return
+    if args.focus:
+        send({"command": "enqueue", "paths": [os.path.abspath(path) for path in args.focus]})
+        print("scanning and queueing focus paths")
+    elif args.number:
+        print(f'queued {send({"command": "enqueue", "count": args.number})["queued"]} files')
+    if args.pause:
+        send({"command": "pause"})
+        print("paused, the current encode will finish")
+    if args.resume:
+        send({"command": "resume"})
+        print("resumed")
+    if args.status:
+        status = send({"command": "status"})
+        stats = send({"command": "stats"})
+        print("paused" if status["paused"] else "running")
+        if status["scanning"]:
+            print("scan running")
+        print(f'encoding: {status["current"]}')
+        print(f'queued: {len(status["queued"])}, encoded since start: {status["encoded"]}')
+        for fileList in ("incomplete_files", "skipped_files", "complete_files", "failed_files"):
+            print(f"{fileList}: {stats[fileList]}")
+
 
 def main():
     scriptDescription = ("""
@@ -29,8 +249,15 @@ def main():
     parser.add_argument("--list-blacklist-paths", "-lbp", action="store_true", help="list blacklisted paths")
     parser.add_argument("--low-profile", action="store_true", help="for weaker devices, convert to 4-bit HEVC including downgrading 10-bit hevc", default=False)
     parser.add_argument("--number", "-n", action="store", help="transcode from tracked paths limit number of files to be converted", type=int)
+    parser.add_argument("--plan", action="store_true", help="estimate encode hours and space saved for the queue, or for --number files, from previous encodes")
     parser.add_argument("--nvenc", action="store_true", help="transcode using NVENC compatible GPU")
     parser.add_argument("--height", action="store", type=int, help="Height of the output resolution to be used for conversion")
+    parser.add_argument("--decode-threads", action="store", type=int, help="threads ffmpeg uses to decode the source")
+    parser.add_argument("--filter-threads", action="store", type=int, help="threads ffmpeg uses for the crop and scale filters")
+    parser.add_argument("--scaler", action="store", choices=["fast_bilinear", "bilinear", "bicubic", "area", "lanczos"],
+        help="scaling algorithm used with --height, fast_bilinear is quickest")
+    parser.add_argument("--benchmark", action="append", metavar="PATH", help="compare encoding fps with and without the decode, filter and scaler settings on a file, nothing is written")
+    parser.add_argument("--auto-crop", action="store_true", help="detect black bars from a few samples of each file and crop them before encoding")
     parser.add_argument("--preset", action="store", type=str,
         help="string for ffmpeg paramater, accepts ultrafast, superfast, veryfast, faster, fast, medium, slow, slower,\
              veryslow and placebo, slower speeds have a higher filesize and better quality")
@@ -40,6 +267,7 @@ def main():
     parser.add_argument("--scan", "-s", action="store_true", help="scan tracked directories for new files")
     parser.add_argument("--quiet", "-q", action="store_true", help="only produce minimal output")
     parser.add_argument("--verbose", "-v", action="store_true", help="produce as much output as possible")
+    parser.add_argument("--abort-ratio", action="store", type=float, help="abort and skip encodes whose projected output exceeds this fraction of the original size, e.g. 0.9")
     parser.add_argument("--vbr", action="store", type=str, help="Set the Variable Bitrate for the encoding pass, this will adjust NVENC quality")
     parser.add_argument("--minrate", action="store", type=str, help="Set the minimum rate for Variable Bitrate mode")
     parser.add_argument("--maxrate", action="store", type=str, help="Set the maximum rate for Variable Bitrate mode")
@@ -48,6 +276,14 @@ def main():
     parser.add_argument("--height-threshold", action="store", type=int, help="Set the minimum height files must have in order to add to processing list during scan")
     parser.add_argument("--height-ceiling", action="store", type=int, help="Set the maximum height files can have in order to add to processing list during scan")
     parser.add_argument("--force-encode", action="store_true", help="force HEVC re-encode")
+    parser.add_argument("--requalify", action="store_true", help="re-apply the rate and height thresholds, ceilings and --force-encode to skipped and incomplete files without rescanning")
+    parser.add_argument("--vp9-bits-per-pixel", action="store", type=float, help="VP9 at or below this many bits per pixel is left as it is during scan, default 0.1")
+    parser.add_argument("--profile", action="store_true", help="print time spent per phase of scanning, probing, committing and encoding on exit")
+    parser.add_argument("--profile-deep", action="store_true", help="with --profile, also print cProfile statistics and the top memory allocators")
+    parser.add_argument("--service", action="store_true", help="keep the library loaded and serve requests on a local socket, later invocations are forwarded to it")
+    parser.add_argument("--status", action="store_true", help="show the queue and file list sizes of the running service")
+    parser.add_argument("--pause", action="store_true", help="pause the running service after its current encode")
+    parser.add_argument("--resume", action="store_true", help="resume a paused service")
     parser.add_argument("--clear-all", action="store_true", help="clear the library of all files")
     parser.add_argument("--clear-skipped", action="store_true", help="clear the library of skipped files")
     parser.add_argument("--clear-incomplete", action="store_true", help="clear the library of incomplete files")
@@ -56,6 +292,9 @@ def main():
 
     args = parser.parse_args()
 
+    if args.profile:
+        profiler.enable(deep=args.profile_deep)
+
     logDirectory = None
     if args.verbose:
         log = logger.setup_logging(logDirectory, "DEBUG")
@@ -64,11 +303,37 @@ def main():
     else:
         log = logger.setup_logging(logDirectory)
 
+    if args.benchmark:
+        for path in args.benchmark:
+            baseline = videoEncoder.X265Encoder(os.path.abspath(path), args)
+            configureEncoder(baseline, args, log)
+            baseline.decode_threads = False
+            baseline.filter_threads = False
+            baseline.scaler = False
+            tuned = videoEncoder.X265Encoder(os.path.abspath(path), args)
+            configureEncoder(tuned, args, log)
+            # run in the order defaults, tuned, tuned, defaults so neither
+            # side gets the benefit of a page cache warmed by the other
+            baselineFps = baseline.benchmark(args, 30)
+            tunedFps = tuned.benchmark(args, 30)
+            tunedFps += tuned.benchmark(args, 30)
+            baselineFps += baseline.benchmark(args, 30)
+            print(f"{path}\nffmpeg defaults: {baselineFps / 2:.1f}fps\ntuned: {tunedFps / 2:.1f}fps")
+        sys.exit()
+
     databaseDir = os.path.abspath(os.path.dirname(sys.argv[0])) + "/database"
     if args.database:
         databasePath = databaseDir + "/" + args.database + ".json"
     else:
         databasePath = databaseDir + "/library.json"
+    socketPath = os.path.splitext(databasePath)[0] + ".sock"
+
+    if not args.service and service.request(socketPath, {"command": "status"}) is not None:
+        serviceClient(socketPath, args)
+        sys.exit()
+    if args.status or args.pause or args.resume:
+        print("no service running")
+        sys.exit(1)
 
     library = mediaTracker.MediaLibrary(databasePath, args)
 
@@ -87,16 +352,30 @@ def main():
     if args.height_ceiling:
         library.height_ceiling = args.height_ceiling
 
+    if args.vp9_bits_per_pixel:
+        library.vp9_bits_per_pixel = args.vp9_bits_per_pixel
+
     if args.low_profile:
         library.low_profile = True
 
     if args.height:
         library.height = args.height
 
+    if args.service:
+        service.LibraryService(
+            library, socketPath,
+            lambda filepath, started: encodeFile(library, filepath, args, log, started), args
+        ).serve()
+        sys.exit()
+
     if args.errors:
         library.showFailed()
         sys.exit()
 
+    if args.requalify:
+        printMoves(library.requalify())
+        sys.exit()
+
     if args.list_paths:
         print(library.listPaths())
         sys.exit()
@@ -139,24 +418,30 @@ def main():
             library.addBlacklistPath(os.path.abspath(path))
 
     if args.saved_space:
-        totalSavedMB = int(library.returnTotalSaved() / 1_000_000)
-        totalSavedGB = (totalSavedMB / 1_000)
-        totalSavedTB = (totalSavedGB / 1_000)
-        if totalSavedTB > 1:
-            print(f"{totalSavedTB}tb")
-        elif totalSavedGB > 1:
-            print(f"{totalSavedGB}gb")
-        else:
-            print(f"{totalSavedMB}mb")
+        printSavedSpace(library.returnTotalSaved())
         sys.exit()
 
     if args.scan:
         for fp in library.listPaths():
             library.scan(fp, args)
 
+    if args.plan:
+        model = throughputModel.ThroughputModel(library.library["complete_files"])
+        encoderName, preset = planSettings(args)
+        printPlan(model.estimateQueue(library.library["incomplete_files"], encoderName, preset, args.number))
+        sys.exit()
+
+    # the running encoder, so focus scans skip its backup and output files
+    running = []
+
+    def started(encoder):
+        running[:] = [encoder]
+
+    def encoderPaths():
+        return [path for encoder in running for path in (encoder.backupFilepath, encoder.outputFilepath)]
+
     if args.focus:
-        for dir in args.focus:
-            convertFilepaths = library.returnDirectory(dir)
+        convertFilepaths = library.focusFiles(args.focus, args, excluded=encoderPaths)
     elif args.number:
         convertFilepaths = library.returnLibraryEntries(args.number)
     else:
@@ -169,72 +454,13 @@ def main():
     # Can't be changes whilst iterating dicts
     for filepath in convertFilepaths:
 
-        print(filepath)
-        beginTime = time.time()
-        libraryEntry = library.library["incomplete_files"][filepath]
-
-        # check json db if encoded before running encoder
-        try:
-            matchLow = args.low_profile and libraryEntry["video_profile"] == "Main"
-            matchHigh = not args.low_profile
-            if libraryEntry["video_codec"] == "hevc" and (matchLow or matchHigh) and (not args.height or args.height == libraryEntry["height"]):
-                library.markComplete(filepath)
-                continue
-        except KeyError:
-            continue
-
-        encoder = videoEncoder.X265Encoder(filepath, args)
-        if args.low_profile:
-            encoder.low_profile = True
-        if args.nvenc:
-            encoder.nvenc = True
-        if args.height:
-            encoder.height = args.height
-        if args.crf:
-            if 0 < args.crf < 51:
-                encoder.crf = args.crf
-            else:
-                raise ValueError("CRF value unacceptable, must be between 0 and 51")
-        if args.preset:
-            validPresets = ["ultrafast", "superfast", "veryfast",
-                            "faster", "fast", "medium", "slow",
-                            "slower", "veryslow", "placebo"]
-            nvencPresets = ["fast", "medium", "slow"]
-            preset = args.preset.lower()
-            if preset in validPresets:
-                if args.nvenc and args.preset.lower() not in nvencPresets:
-                    log.error("invalid nvenc preset passed with nvenc selected, please use fast, medium, or slow")
-                    sys.exit()
-                encoder.preset = preset
-            else:
-                raise ValueError("preset not a valid argument, please use ultrafast, superfast, veryfast, faster, fast, medium, slow, slower, veryslow or placebo")
-        if args.height:
-            encoder.height = args.height
-        if args.vbr:
-            encoder.vbr = args.vbr
-            if args.minrate:
-                encoder.minrate = args.minrate
-            if args.maxrate:
-                encoder.maxrate = args.maxrate
-            
-        try:
-            encodeResult = encoder.encode(args)
-        except videoEncoder.AlreadyEncodedError:
-            library.markComplete(filepath)
-            continue
-        except (videoEncoder.InvalidFileError, videoEncoder.EncoderFailedError) as e:
+        result = encodeFile(library, filepath, args, log, started)
+        if result is None:
             failedFilepaths.append(filepath)
-            errorMessage = f"x265 convert failed with error: {e}"
-            library.markFailed(filepath, errorMessage)
             continue
-
-        library.markComplete(filepath, encodeResult)
-        fileSpaceSaved = library.library["complete_files"][encodeResult]["space_saved"]
+        fileSpaceSaved, elapsedTime = result
         spaceSaved += fileSpaceSaved
-        elapsedTime = time.time() - beginTime
         totalElapsedTime = totalElapsedTime + elapsedTime
-        elapsedTimeString = time.strftime("%H:%M:%S", time.localtime(elapsedTime))
-        log.info(f"space saved {fileSpaceSaved/1_000_000} : time taken {elapsedTimeString}.")
 
     if len(failedFilepaths) > 0:
         log.warning("Some files failed, recommended manual conversion")
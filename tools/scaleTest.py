@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Load test MediaLibrary against a synthetic library.
+
+Builds a directory tree of empty placeholder files and stand-in ffprobe and
+ffmpeg executables, then times scan, returnLibraryEntries, markComplete,
+markFailed and a few encodes at each requested size, reporting wall time,
+resident memory and bytes written per operation.
+
+The stand-ins read their scripted behaviour from the file name, which the
+tree generator writes as "<number> <codec>-<height>-<kbps>.<extension>".
+A codec of "fail" makes both of them exit with an error.
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from library import mediaRecords
+from library import mediaTracker
+from library import videoEncoder
+
+FFPROBE = r"""#!/bin/sh
+for path; do :; done
+name="${path##*/}"
+meta="${name#* }"
+meta="${meta%.*}"
+codec="${meta%%-*}"
+rest="${meta#*-}"
+height="${rest%%-*}"
+rate="${rest#*-}"
+[ -n "$SCALETEST_PROBE_LATENCY" ] && sleep "$SCALETEST_PROBE_LATENCY"
+[ "$codec" = "fail" ] && exit 1
+width=$((height * 16 / 9))
+echo "[AVIOContext @ 0x0] Statistics: 65536 bytes read, 0 seeks" >&2
+cat <<EOF
+{"streams": [{"index": 0, "codec_type": "video", "codec_name": "$codec", "profile": "Main",
+  "width": $width, "height": $height, "avg_frame_rate": "24/1", "disposition": {"attached_pic": 0}},
+  {"index": 1, "codec_type": "audio", "codec_name": "aac", "disposition": {"attached_pic": 0}}],
+ "format": {"size": "$((rate * 1000 * 2700 / 8))", "duration": "2700.0", "bit_rate": "$((rate * 1000))"}}
+EOF
+"""
+
+FFMPEG = r"""#!/bin/sh
+for output; do :; done
+case "$output" in *" fail-"*) exit 1 ;; esac
+# waited on in the background so terminate() stops it like a real ffmpeg
+if [ -n "$SCALETEST_ENCODE_LATENCY" ]; then sleep "$SCALETEST_ENCODE_LATENCY" & wait $!; fi
+printf 'placeholder' > "$output"
+printf 'total_size=11\nout_time_us=2700000000\nprogress=end\n'
+"""
+
+# (codec, height, kbps) cycled through when naming files
+PROFILES = [
+    ("h264", 1080, 8000),
+    ("h264", 720, 3000),
+    ("hevc", 1080, 4000),
+    ("mpeg4", 480, 1200),
+    ("vp9", 1080, 2500),
+    ("av1", 2160, 9000),
+    ("h264", 2160, 25000),
+]
+
+
+def bytesWritten():
+    """Return bytes this process has written, 0 where /proc is unavailable."""
+    try:
+        with open("/proc/self/io") as stats:
+            for line in stats:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def writeStandIns(binDirectory):
+    for name, script in (("ffprobe", FFPROBE), ("ffmpeg", FFMPEG)):
+        path = os.path.join(binDirectory, name)
+        with open(path, "w") as standIn:
+            standIn.write(script)
+        os.chmod(path, 0o755)
+
+
+def buildTree(root, count, failureRate):
+    """Create count placeholder videos under root/media plus noise.
+       Returns the blacklisted directory."""
+    media = os.path.join(root, "media")
+    blacklisted = os.path.join(media, "blacklisted")
+    failEvery = int(1 / failureRate) if failureRate else 0
+    for number in range(count):
+        codec, height, rate = PROFILES[number % len(PROFILES)]
+        if failEvery and number % failEvery == 0:
+            codec = "fail"
+        if number % 20 == 19:
+            # a subtree that scans have to skip
+            directory = os.path.join(blacklisted, f"show {number // 400}")
+        elif number % 50 == 7:
+            # paths over the 255 character limit scan refuses
+            directory = os.path.join(media, "long", "very long directory name " * 10)
+        else:
+            directory = os.path.join(media, f"show {number // 400}", f"season {number // 20 % 20}")
+        os.makedirs(directory, exist_ok=True)
+        extension = (".mkv", ".MKV", ".avi", ".mp4", ".webm")[number % 5]
+        open(os.path.join(directory, f"{number:07d} {codec}-{height}-{rate}{extension}"), "w").close()
+        if number % 10 == 3:
+            # files scan must ignore
+            open(os.path.join(directory, f"{number:07d}.nfo"), "w").close()
+            open(os.path.join(directory, f"{number:07d}"), "w").close()
+    return blacklisted
+
+
+def measure(results, size, operation, function, count=1):
+    memoryBefore = mediaRecords.residentMemory() or 0
+    writtenBefore = bytesWritten()
+    beginTime = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(count):
+            function()
+    elapsed = time.perf_counter() - beginTime
+    results.append((
+        size, operation, count, elapsed,
+        ((mediaRecords.residentMemory() or 0) - memoryBefore),
+        bytesWritten() - writtenBefore,
+    ))
+
+
+def runSize(workDirectory, size, args):
+    root = os.path.join(workDirectory, str(size))
+    blacklisted = buildTree(root, size, args.failure_rate)
+    libraryArgs = argparse.Namespace(verbose=False, quiet=True)
+    library = mediaTracker.MediaLibrary(os.path.join(root, "database", "library.json"), libraryArgs)
+    library.library["blacklist"].append(blacklisted)
+    results = []
+
+    measure(results, size, "scan", lambda: library.scan(os.path.join(root, "media"), libraryArgs))
+    measure(results, size, "returnLibraryEntries", lambda: library.returnLibraryEntries(args.number), 10)
+
+    queue = iter(list(library.library["incomplete_files"]))
+    measure(results, size, "markComplete", lambda: library.markComplete(next(queue)), args.marks)
+    measure(results, size, "markFailed", lambda: library.markFailed(next(queue), "scale test"), args.marks)
+
+    def encodeNext():
+        filepath = next(queue)
+        entry = library.library["incomplete_files"][filepath]
+        encoder = videoEncoder.X265Encoder(filepath, libraryArgs)
+        encoder.subtitles = entry.get("subtitles")
+        encoder.remux = entry.get("action") == "remux"
+        library.markComplete(filepath, encoder.encode(libraryArgs), encoder.encodeStats())
+
+    measure(results, size, "encode", encodeNext, args.encodes)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", action="store", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+        help="library sizes to test")
+    parser.add_argument("--failure-rate", action="store", type=float, default=0.01,
+        help="fraction of files the stand-ins fail on")
+    parser.add_argument("--probe-latency", action="store", type=str, help="seconds each stand-in ffprobe sleeps")
+    parser.add_argument("--encode-latency", action="store", type=str, help="seconds each stand-in ffmpeg sleeps")
+    parser.add_argument("--number", "-n", action="store", type=int, default=10, help="entries requested per returnLibraryEntries")
+    parser.add_argument("--marks", action="store", type=int, default=10, help="markComplete and markFailed calls per size")
+    parser.add_argument("--encodes", action="store", type=int, default=5, help="encodes per size")
+    parser.add_argument("--workdir", action="store", help="directory for the synthetic trees, kept afterwards")
+    args = parser.parse_args()
+
+    workDirectory = args.workdir or tempfile.mkdtemp(prefix="scaletest")
+    binDirectory = os.path.join(workDirectory, "bin")
+    os.makedirs(binDirectory, exist_ok=True)
+    writeStandIns(binDirectory)
+    os.environ["PATH"] = binDirectory + os.pathsep + os.environ["PATH"]
+    if args.probe_latency:
+        os.environ["SCALETEST_PROBE_LATENCY"] = args.probe_latency
+    if args.encode_latency:
+        os.environ["SCALETEST_ENCODE_LATENCY"] = args.encode_latency
+
+    print(f"{'entries':>9} {'operation':<22}{'count':>6}{'wall s':>10}{'per op ms':>11}{'rss mb':>9}{'written mb':>12}")
+    try:
+        for size in args.entries:
+            for size, operation, count, elapsed, memory, written in runSize(workDirectory, size, args):
+                print(f"{size:>9} {operation:<22}{count:>6}{elapsed:>10.2f}{elapsed / count * 1000:>11.2f}"
+                      f"{memory / 1_000_000:>9.1f}{written / 1_000_000:>12.1f}")
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workDirectory)
+
+
+if __name__ == "__main__":
+    main()